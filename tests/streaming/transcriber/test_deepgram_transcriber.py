@@ -0,0 +1,528 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+import pytest
+from scipy.signal import lfilter
+from websockets.exceptions import ConnectionClosedOK, WebSocketException
+
+from vocode.streaming.models.audio_encoding import AudioEncoding
+from vocode.streaming.models.transcriber import DeepgramTranscriberConfig
+from vocode.streaming.transcriber import deepgram_transcriber
+from vocode.streaming.transcriber.base_transcriber import Transcription
+from vocode.streaming.transcriber.deepgram_transcriber import (
+    NUM_RESTARTS,
+    REDIS_AUDIO_CHANNEL,
+    REDIS_PUBLISH_BATCH_SIZE,
+    REDIS_QUEUE_MAX_SIZE,
+    STABLE_CONNECTION_SECONDS,
+    TERMINATE_MSG,
+    DeepgramTranscriber,
+)
+
+
+def create_transcriber(downsampling: int = 3) -> DeepgramTranscriber:
+    return DeepgramTranscriber(
+        DeepgramTranscriberConfig(
+            sampling_rate=8000,
+            audio_encoding=AudioEncoding.LINEAR16,
+            chunk_size=2048,
+            downsampling=downsampling,
+        ),
+        api_key="test",
+    )
+
+
+def reference_downsample(
+    transcriber: DeepgramTranscriber, samples: np.ndarray
+) -> np.ndarray:
+    filtered = lfilter(transcriber._resample_taps, 1.0, samples.astype(np.float64))
+    decimated = filtered[:: transcriber._downsampling]
+    return np.clip(np.rint(decimated), -32768, 32767).astype(np.int16)
+
+
+def downsample_in_chunks(
+    transcriber: DeepgramTranscriber, samples: np.ndarray, chunk_sizes
+) -> np.ndarray:
+    output = b""
+    start = 0
+    i = 0
+    while start < len(samples):
+        end = start + chunk_sizes[i % len(chunk_sizes)]
+        output += transcriber.downsample(samples[start:end].tobytes())
+        start = end
+        i += 1
+    return np.frombuffer(output, dtype=np.int16)
+
+
+@pytest.mark.parametrize("downsampling", [2, 3])
+def test_downsample_is_continuous_across_chunks(downsampling):
+    rng = np.random.default_rng(0)
+    samples = (rng.standard_normal(10007) * 3000).astype(np.int16)
+    transcriber = create_transcriber(downsampling)
+
+    output = downsample_in_chunks(transcriber, samples, [333, 1000, 7, 160])
+
+    expected = reference_downsample(transcriber, samples)
+    assert len(output) == len(expected)
+    # float32 taps against a float64 reference can round one step apart
+    np.testing.assert_allclose(output, expected, atol=1)
+
+
+def test_downsample_carries_phase_through_short_chunks():
+    rng = np.random.default_rng(1)
+    samples = (rng.standard_normal(1001) * 3000).astype(np.int16)
+    transcriber = create_transcriber(3)
+
+    # chunks shorter than the downsampling factor produce at most one sample
+    output = downsample_in_chunks(transcriber, samples, [1, 2, 1, 1])
+
+    expected = reference_downsample(transcriber, samples)
+    assert len(output) == len(expected)
+    np.testing.assert_allclose(output, expected, atol=1)
+
+
+def test_downsample_clips_to_int16():
+    # a full scale step rings past the int16 range after lowpass filtering
+    samples = np.concatenate(
+        (np.full(300, -32768, dtype=np.int16), np.full(300, 32767, dtype=np.int16))
+    )
+    transcriber = create_transcriber(3)
+
+    filtered = lfilter(transcriber._resample_taps, 1.0, samples.astype(np.float64))
+    assert filtered.max() > 32767 and filtered.min() < -32768
+
+    output = np.frombuffer(transcriber.downsample(samples.tobytes()), dtype=np.int16)
+
+    assert output.max() == 32767
+    assert output.min() == -32768
+    np.testing.assert_allclose(
+        output, reference_downsample(transcriber, samples), atol=1
+    )
+
+
+def test_downsample_passes_empty_chunks_through():
+    rng = np.random.default_rng(2)
+    samples = (rng.standard_normal(1000) * 3000).astype(np.int16)
+    transcriber = create_transcriber(3)
+
+    assert transcriber.downsample(b"") == b""
+    # an empty chunk leaves the filter tail and phase untouched
+    output = downsample_in_chunks(transcriber, samples, [100, 0, 1, 0])
+
+    expected = reference_downsample(transcriber, samples)
+    assert len(output) == len(expected)
+    np.testing.assert_allclose(output, expected, atol=1)
+
+
+def run_loop_with_outcomes(monkeypatch, transcriber, outcomes):
+    # each outcome is what one process() call does before returning:
+    # "error" fails the handshake, "transcription" receives a result and
+    # "stable" keeps the connection up past STABLE_CONNECTION_SECONDS
+    calls = []
+    delays = []
+
+    async def process():
+        outcome = outcomes[len(calls)] if len(calls) < len(outcomes) else "error"
+        calls.append(outcome)
+        if outcome == "error":
+            raise WebSocketException("handshake failed")
+        transcriber.last_connected_at = time.monotonic()
+        if outcome == "transcription":
+            transcriber.received_transcription = True
+        elif outcome == "stable":
+            transcriber.last_connected_at -= STABLE_CONNECTION_SECONDS
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(transcriber, "process", process)
+    monkeypatch.setattr(deepgram_transcriber, "_sleep", sleep)
+    monkeypatch.setattr(deepgram_transcriber, "_jitter", lambda: 0.0)
+    return calls, delays
+
+
+@pytest.mark.asyncio
+async def test_run_loop_backs_off_until_restart_budget_is_spent(monkeypatch):
+    transcriber = create_transcriber()
+    calls, delays = run_loop_with_outcomes(monkeypatch, transcriber, [])
+
+    await transcriber._run_loop()
+
+    assert len(calls) == NUM_RESTARTS
+    assert delays == [2, 4, 8, 16]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("healthy_outcome", ["transcription", "stable"])
+async def test_run_loop_resets_budget_after_healthy_connection(
+    monkeypatch, healthy_outcome
+):
+    transcriber = create_transcriber()
+    calls, delays = run_loop_with_outcomes(
+        monkeypatch, transcriber, ["error", "error", healthy_outcome]
+    )
+
+    await transcriber._run_loop()
+
+    assert len(calls) == NUM_RESTARTS + 2
+    assert delays == [2, 4, 2, 4, 8, 16]
+
+
+@pytest.mark.asyncio
+async def test_run_loop_stops_when_terminated_during_backoff(monkeypatch):
+    transcriber = create_transcriber()
+    calls, delays = run_loop_with_outcomes(monkeypatch, transcriber, [])
+
+    async def sleep(delay):
+        delays.append(delay)
+        transcriber._ended = True
+
+    monkeypatch.setattr(deepgram_transcriber, "_sleep", sleep)
+
+    await transcriber._run_loop()
+
+    assert len(calls) == 1
+    assert delays == [2]
+
+
+@pytest.mark.asyncio
+async def test_run_loop_keeps_redis_publisher_across_reconnects(monkeypatch):
+    transcriber = create_transcriber()
+    calls, delays = run_loop_with_outcomes(monkeypatch, transcriber, [])
+    publisher_tasks = set()
+
+    async def process():
+        publisher_tasks.add(transcriber._redis_publisher_task)
+        raise WebSocketException("handshake failed")
+
+    monkeypatch.setattr(transcriber, "process", process)
+
+    await transcriber._run_loop()
+
+    assert len(publisher_tasks) == 1
+    assert transcriber._redis_publisher_task.cancelled()
+
+
+# marks a point in a FakeWebSocket script where recv() yields to the event loop
+TICK = object()
+
+
+class FakeWebSocket:
+    # replays a script of Deepgram frames. Frames between two TICKs are read
+    # within one event loop tick, and once the script runs out recv() waits
+    # for the CloseStream message like the Deepgram server does.
+    def __init__(self, script):
+        self.script = list(script)
+        self.num_frames_read = 0
+        self.closed = asyncio.Event()
+        self.transport = self
+
+    def get_extra_info(self, name):
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def send(self, data):
+        if data == TERMINATE_MSG:
+            self.closed.set()
+
+    async def recv(self, decode=None):
+        while self.script:
+            frame = self.script.pop(0)
+            if frame is TICK:
+                await asyncio.sleep(0)
+                continue
+            self.num_frames_read += 1
+            return frame
+        await self.closed.wait()
+        raise ConnectionClosedOK(None, None)
+
+
+def results_frame(
+    transcript, is_final=False, speech_final=False, start=0.0, confidence=0.9
+):
+    return json.dumps(
+        {
+            "type": "Results",
+            "channel_index": [0, 1],
+            "duration": 0.5,
+            "start": start,
+            "is_final": is_final,
+            "speech_final": speech_final,
+            "channel": {
+                "alternatives": [
+                    {
+                        "transcript": transcript,
+                        "confidence": confidence,
+                        "words": [
+                            {
+                                "word": word,
+                                "start": start,
+                                "end": start + 0.5,
+                                "confidence": confidence,
+                            }
+                            for word in transcript.split()
+                        ],
+                    }
+                ]
+            },
+            "metadata": {"request_id": "test", "model_uuid": "test"},
+        }
+    ).encode()
+
+
+async def receive_script(monkeypatch, transcriber, script):
+    ws = FakeWebSocket(script)
+    monkeypatch.setattr(deepgram_transcriber, "connect", lambda *args, **kwargs: ws)
+    process_task = asyncio.create_task(transcriber.process())
+    # the fake only yields at a TICK, so a few extra ticks let the receiver
+    # and any interim flush run to completion
+    for _ in range(script.count(TICK) + 3):
+        await asyncio.sleep(0)
+    transcriber.terminate()
+    await process_task
+    transcriptions = []
+    while not transcriber.output_queue.empty():
+        transcriptions.append(transcriber.output_queue.get_nowait())
+    return transcriptions, ws
+
+
+@pytest.mark.asyncio
+async def test_receiver_only_delivers_latest_interim_of_a_tick(monkeypatch):
+    transcriber = create_transcriber()
+
+    transcriptions, _ = await receive_script(
+        monkeypatch,
+        transcriber,
+        [
+            results_frame("hello", is_final=True),
+            results_frame("there", is_final=True),
+            results_frame("friend", is_final=True),
+        ],
+    )
+
+    assert [(t.message, t.is_final) for t in transcriptions] == [
+        ("hello there friend", False)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_receiver_final_supersedes_pending_interim(monkeypatch):
+    transcriber = create_transcriber()
+
+    transcriptions, _ = await receive_script(
+        monkeypatch,
+        transcriber,
+        [
+            results_frame("hello", is_final=True),
+            results_frame("there", is_final=True, speech_final=True),
+        ],
+    )
+
+    assert [(t.message, t.is_final) for t in transcriptions] == [("hello there", True)]
+
+
+@pytest.mark.asyncio
+async def test_receiver_delivers_interim_from_a_later_tick(monkeypatch):
+    transcriber = create_transcriber()
+
+    transcriptions, _ = await receive_script(
+        monkeypatch,
+        transcriber,
+        [
+            results_frame("hello", is_final=True),
+            TICK,
+            results_frame("there", is_final=True),
+            TICK,
+            results_frame("friend", is_final=True, speech_final=True),
+        ],
+    )
+
+    assert [(t.message, t.is_final) for t in transcriptions] == [
+        ("hello", False),
+        ("hello there", False),
+        ("hello there friend", True),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_receiver_decodes_results_frame(monkeypatch):
+    transcriber = create_transcriber()
+
+    transcriptions, _ = await receive_script(
+        monkeypatch,
+        transcriber,
+        [results_frame("hello world", is_final=True, speech_final=True, start=1.5)],
+    )
+
+    assert [(t.message, t.confidence, t.is_final) for t in transcriptions] == [
+        ("hello world", 0.9, True)
+    ]
+    assert transcriber.received_transcription
+
+
+@pytest.mark.asyncio
+async def test_receiver_decodes_integer_results_fields(monkeypatch):
+    transcriber = create_transcriber()
+
+    transcriptions, _ = await receive_script(
+        monkeypatch,
+        transcriber,
+        [
+            results_frame(
+                "hello", is_final=True, speech_final=True, start=2, confidence=1
+            )
+        ],
+    )
+
+    assert [(t.message, t.is_final) for t in transcriptions] == [("hello", True)]
+    assert type(transcriptions[0].confidence) is float
+
+
+@pytest.mark.asyncio
+async def test_receiver_stops_at_metadata_frame(monkeypatch):
+    transcriber = create_transcriber()
+    metadata_frame = json.dumps(
+        {
+            "type": "Metadata",
+            "transaction_key": "deprecated",
+            "request_id": "test",
+            "created": "2024-01-01T00:00:00.000Z",
+            "duration": 3.0,
+            "channels": 1,
+        }
+    ).encode()
+
+    transcriptions, ws = await receive_script(
+        monkeypatch,
+        transcriber,
+        [metadata_frame, results_frame("hello", is_final=True, speech_final=True)],
+    )
+
+    assert transcriptions == []
+    assert ws.num_frames_read == 1
+
+
+@pytest.mark.asyncio
+async def test_receiver_skips_event_frames(monkeypatch):
+    transcriber = create_transcriber()
+    # event messages carry the channel index array where results carry an
+    # object, so they do not fit the results schema
+    speech_started_frame = json.dumps(
+        {"type": "SpeechStarted", "channel": [0, 1], "timestamp": 0.0}
+    ).encode()
+    utterance_end_frame = json.dumps(
+        {"type": "UtteranceEnd", "channel": [0, 1], "last_word_end": 0.5}
+    ).encode()
+
+    transcriptions, ws = await receive_script(
+        monkeypatch,
+        transcriber,
+        [
+            speech_started_frame,
+            results_frame("hello", is_final=True, speech_final=True),
+            utterance_end_frame,
+        ],
+    )
+
+    assert [(t.message, t.is_final) for t in transcriptions] == [("hello", True)]
+    assert ws.num_frames_read == 3
+
+
+@pytest.mark.asyncio
+async def test_terminate_drops_pending_interim():
+    transcriber = create_transcriber()
+
+    transcriber.queue_interim(
+        Transcription(message="hello", confidence=0.9, is_final=False)
+    )
+    transcriber.terminate()
+    await asyncio.sleep(0)
+
+    assert transcriber.output_queue.empty()
+
+
+class FakeRedis:
+    # records every executed pipeline as one batch of published chunks
+    def __init__(self):
+        self.batches = []
+        self.batch_executed = asyncio.Event()
+
+    def pipeline(self, transaction=True):
+        assert not transaction
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.published = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def publish(self, channel, message):
+        assert channel == REDIS_AUDIO_CHANNEL
+        self.published.append(message)
+
+    async def execute(self):
+        self.redis.batches.append(self.published)
+        self.redis.batch_executed.set()
+
+
+async def publish_until(transcriber, redis, num_batches):
+    publisher_task = asyncio.create_task(transcriber.redis_publisher())
+    while len(redis.batches) < num_batches:
+        redis.batch_executed.clear()
+        await asyncio.wait_for(redis.batch_executed.wait(), 1)
+    publisher_task.cancel()
+
+
+def audio_chunk(index):
+    return index.to_bytes(2, "little")
+
+
+@pytest.mark.asyncio
+async def test_redis_publisher_drops_oldest_chunks_and_batches(monkeypatch):
+    transcriber = create_transcriber(1)
+    redis = FakeRedis()
+    monkeypatch.setattr(transcriber, "_redis", redis)
+
+    num_chunks = 300
+    for i in range(num_chunks):
+        transcriber.send_audio(audio_chunk(i))
+    await publish_until(
+        transcriber, redis, REDIS_QUEUE_MAX_SIZE // REDIS_PUBLISH_BATCH_SIZE
+    )
+
+    first_kept = num_chunks - REDIS_QUEUE_MAX_SIZE
+    assert first_kept == 44
+    assert [len(batch) for batch in redis.batches] == [REDIS_PUBLISH_BATCH_SIZE] * 8
+    assert [chunk for batch in redis.batches for chunk in batch] == [
+        audio_chunk(i) for i in range(first_kept, num_chunks)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_redis_publisher_flushes_partial_batch(monkeypatch):
+    transcriber = create_transcriber(1)
+    redis = FakeRedis()
+    monkeypatch.setattr(transcriber, "_redis", redis)
+
+    for i in range(3):
+        transcriber.send_audio(audio_chunk(i))
+    # a partial batch goes out once the flush interval has passed
+    await publish_until(transcriber, redis, 1)
+    transcriber.send_audio(audio_chunk(3))
+    await publish_until(transcriber, redis, 2)
+
+    assert redis.batches == [[audio_chunk(i) for i in range(3)], [audio_chunk(3)]]
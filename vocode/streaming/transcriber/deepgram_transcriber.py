@@ -1,10 +1,14 @@
 import asyncio
 import json
 import logging
-import redis
-from typing import Optional
-import websockets
-from websockets.client import WebSocketClientProtocol
+import msgspec
+import random
+import socket
+import time
+from redis.exceptions import RedisError
+from typing import Callable, List, Optional
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import WebSocketException
 import audioop
 from urllib.parse import urlencode
 from vocode import getenv
@@ -22,11 +26,50 @@ from vocode.streaming.models.transcriber import (
     TimeEndpointingConfig,
 )
 from vocode.streaming.models.audio_encoding import AudioEncoding
-import sounddevice as sd
+from vocode.streaming.utils.redis_pool import get_redis_client
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import firwin
 
-PUNCTUATION_TERMINATORS = [".", "!", "?"]
+PUNCTUATION_TERMINATORS = frozenset(".!?")
 NUM_RESTARTS = 5
+TERMINATE_MSG = json.dumps({"type": "CloseStream"})
+MAX_RESTART_DELAY_SECONDS = 30.0
+# a connection that stayed up this long is not counted as a failed attempt
+STABLE_CONNECTION_SECONDS = 30.0
+REDIS_AUDIO_CHANNEL = "PersonAudio-audio"
+# publishes are flushed in one pipeline once this many chunks are queued
+# or the flush interval has elapsed since the first queued chunk
+REDIS_PUBLISH_BATCH_SIZE = 32
+REDIS_PUBLISH_FLUSH_INTERVAL_SECONDS = 0.01
+REDIS_QUEUE_MAX_SIZE = 256
+# length of the anti-aliasing filter per unit of downsampling factor
+RESAMPLE_TAPS_PER_PHASE = 16
+
+
+class DeepgramWord(msgspec.Struct):
+    end: float
+
+
+class DeepgramAlternative(msgspec.Struct):
+    transcript: str
+    confidence: float
+    words: List[DeepgramWord] = []
+
+
+class DeepgramChannel(msgspec.Struct):
+    alternatives: List[DeepgramAlternative]
+
+
+class DeepgramMsg(msgspec.Struct):
+    # only the fields the receiver reads are decoded, everything else in the
+    # response is skipped. Messages without is_final (e.g. the closing
+    # metadata) mark the end of the transcription stream
+    is_final: Optional[bool] = None
+    speech_final: bool = False
+    start: float = 0.0
+    duration: float = 0.0
+    channel: Optional[DeepgramChannel] = None
 
 
 avg_latency_hist = meter.create_histogram(
@@ -45,16 +88,34 @@ duration_hist = meter.create_histogram(
     name="transcriber.deepgram.duration",
     unit="seconds",
 )
-redis_client = redis.Redis(host="localhost", port=6379, db=0)
+# 16-bit linear PCM value for every MuLaw byte
+ULAW_LUT = np.frombuffer(audioop.ulaw2lin(bytes(range(256)), 2), dtype=np.int16)
+
+
+def ends_with_punctuation(transcript: str) -> bool:
+    # walk back over trailing whitespace instead of allocating a stripped copy
+    i = len(transcript) - 1
+    while i >= 0 and transcript[i].isspace():
+        i -= 1
+    return i >= 0 and transcript[i] in PUNCTUATION_TERMINATORS
+
+
+# the restart backoff goes through these so tests can replace them without
+# patching asyncio or random for the whole process
+async def _sleep(delay: float):
+    await asyncio.sleep(delay)
+
+
+def _jitter() -> float:
+    return random.uniform(0, 0.5)
 
 
 def play_audio_chunk(chunk, samplerate=16000):
-    try:
-        # Convert MuLaw encoded audio to Linear PCM
-        linear_pcm_chunk = audioop.ulaw2lin(chunk, 2)
+    import sounddevice as sd
 
-        # Convert the linear PCM chunk to a NumPy array
-        numpy_chunk = np.frombuffer(linear_pcm_chunk, dtype=np.int16)
+    try:
+        # Convert MuLaw encoded audio to a Linear PCM NumPy array
+        numpy_chunk = ULAW_LUT[np.frombuffer(chunk, dtype=np.uint8)]
 
         # Play the audio
         sd.play(numpy_chunk, samplerate)
@@ -79,44 +140,158 @@ class DeepgramTranscriber(BaseAsyncTranscriber[DeepgramTranscriberConfig]):
         self._ended = False
         self.is_ready = False
         self.logger = logger or logging.getLogger(__name__)
-        self.audio_cursor = 0.0
+        num_channels = 1
+        sample_width = 2
+        self._bytes_per_second = float(
+            self.transcriber_config.sampling_rate * num_channels * sample_width
+        )
+        # bytes of audio sent on the current connection, converted to seconds
+        # only when latencies are recorded
+        self.audio_cursor_bytes = 0
+        self.received_transcription = False
+        self.last_connected_at: Optional[float] = None
+        self._redis = get_redis_client()
+        self._redis_queue: asyncio.Queue[bytes] = asyncio.Queue(
+            maxsize=REDIS_QUEUE_MAX_SIZE
+        )
+        self._redis_publisher_task: Optional[asyncio.Task] = None
+        # the config is fixed for the lifetime of the transcriber, so the url
+        # is reused across reconnects
+        self._deepgram_url = self._build_deepgram_url()
+        self._is_speech_final = self._build_is_speech_final()
+        self._decoder = msgspec.json.Decoder(DeepgramMsg)
+        self._pending_interim: Optional[Transcription] = None
+        self._flush_handle: Optional[asyncio.Handle] = None
+        # a factor of 1 means the input is passed through untouched
+        self._downsampling: int = 1
+        if self.transcriber_config.audio_encoding == AudioEncoding.LINEAR16:
+            self._downsampling = self.transcriber_config.downsampling or 1
+        self._resample_taps: np.ndarray = np.ones(1, dtype=np.float32)
+        if self._downsampling > 1:
+            # the lowpass is symmetric, so it doubles as its own time reversal
+            self._resample_taps = firwin(
+                RESAMPLE_TAPS_PER_PHASE * self._downsampling + 1,
+                1.0 / self._downsampling,
+            ).astype(np.float32)
+        self._resample_tail = np.zeros(len(self._resample_taps) - 1, dtype=np.float32)
+        self._resample_phase = 0
+
+    @property
+    def audio_cursor(self) -> float:
+        return self.audio_cursor_bytes / self._bytes_per_second
 
     async def _run_loop(self):
-        restarts = 0
-        while not self._ended and restarts < NUM_RESTARTS:
-            await self.process()
-            restarts += 1
-            self.logger.debug(
-                "Deepgram connection died, restarting, num_restarts: %s", restarts
-            )
+        # the redis mirror outlives individual Deepgram connections, so it runs
+        # for as long as the transcriber does
+        self._redis_publisher_task = asyncio.create_task(self.redis_publisher())
+        try:
+            restarts = 0
+            # also re-checked after each backoff, so terminating mid-sleep does not
+            # open another connection
+            while not self._ended and restarts < NUM_RESTARTS:
+                self.received_transcription = False
+                self.last_connected_at = None
+                try:
+                    await self.process()
+                except (
+                    WebSocketException,
+                    OSError,
+                    asyncio.exceptions.TimeoutError,
+                ) as e:
+                    self.logger.debug(f"Got error {e} connecting to Deepgram")
+                if self.received_transcription or (
+                    self.last_connected_at is not None
+                    and time.monotonic() - self.last_connected_at
+                    >= STABLE_CONNECTION_SECONDS
+                ):
+                    restarts = 0
+                restarts += 1
+                if self._ended or restarts >= NUM_RESTARTS:
+                    break
+                # back off with jitter so that a Deepgram outage does not turn into
+                # a burst of reconnects from every transcriber at once
+                delay = min(MAX_RESTART_DELAY_SECONDS, 2**restarts + _jitter())
+                self.logger.debug(
+                    "Deepgram connection died, restarting in %.2fs, num_restarts: %s",
+                    delay,
+                    restarts,
+                )
+                await _sleep(delay)
+        finally:
+            self._redis_publisher_task.cancel()
+            try:
+                await self._redis_publisher_task
+            except asyncio.CancelledError:
+                pass
 
     def send_audio(self, chunk):
         # Determine the audio format and process accordingly
 
-        if self.transcriber_config.audio_encoding == AudioEncoding.LINEAR16:
-            if self.transcriber_config.downsampling:
-                chunk, _ = audioop.ratecv(
-                    chunk,
-                    2,  # Assuming the audio is 16-bit samples (2 bytes per sample)
-                    1,  # Assuming mono audio. Change this if it's stereo.
-                    self.transcriber_config.sampling_rate
-                    * self.transcriber_config.downsampling,
-                    self.transcriber_config.sampling_rate,
-                    None,
-                )
-            chunk = np.frombuffer(chunk, dtype=np.int16)
+        if self._downsampling > 1:
+            chunk = self.downsample(chunk)
 
-        redis_client.publish(f"PersonAudio-audio", chunk)
+        # publish the raw PCM bytes, redis would otherwise serialize an array
+        # through its text representation
+        if self._redis_queue.full():
+            # redis is falling behind, drop the oldest chunk instead of
+            # buffering without bound
+            self._redis_queue.get_nowait()
+        self._redis_queue.put_nowait(chunk)
 
         super().send_audio(chunk)
 
+    def downsample(self, chunk: bytes) -> bytes:
+        # polyphase decimation: only the filter outputs that survive the
+        # downsampling are computed, each as a dot product over a window of
+        # the 16-bit mono input. The filter tail and the decimation phase carry
+        # over between chunks so that chunk boundaries are seamless.
+        if not chunk:
+            return b""
+        downsampling = self._downsampling
+        samples = np.frombuffer(chunk, dtype=np.int16).astype(np.float32)
+        history = np.concatenate((self._resample_tail, samples))
+        windows = sliding_window_view(history, len(self._resample_taps))[
+            self._resample_phase :: downsampling
+        ]
+        filtered = windows @ self._resample_taps
+        self._resample_phase += len(windows) * downsampling - len(samples)
+        self._resample_tail = history[len(samples) :]
+        return np.clip(np.rint(filtered), -32768, 32767).astype(np.int16).tobytes()
+
+    def queue_interim(self, transcription: Transcription):
+        # interim results that arrive within the same event loop tick
+        # supersede each other, so only the latest one is put on the queue
+        self._pending_interim = transcription
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(
+                self._flush_interim
+            )
+
+    def _flush_interim(self):
+        if self._pending_interim is not None:
+            self.output_queue.put_nowait(self._pending_interim)
+        self._pending_interim = None
+        self._flush_handle = None
+
+    def cancel_interim(self):
+        # a final transcription supersedes any interim still waiting to flush
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._pending_interim = None
+        self._flush_handle = None
+
     def terminate(self):
-        terminate_msg = json.dumps({"type": "CloseStream"})
-        self.input_queue.put_nowait(terminate_msg)
+        self.input_queue.put_nowait(TERMINATE_MSG)
         self._ended = True
+        self.cancel_interim()
+        if self._redis_publisher_task is not None:
+            self._redis_publisher_task.cancel()
         super().terminate()
 
     def get_deepgram_url(self):
+        return self._deepgram_url
+
+    def _build_deepgram_url(self):
         if self.transcriber_config.audio_encoding == AudioEncoding.LINEAR16:
             encoding = "linear16"
         elif self.transcriber_config.audio_encoding == AudioEncoding.MULAW:
@@ -148,108 +323,179 @@ class DeepgramTranscriber(BaseAsyncTranscriber[DeepgramTranscriberConfig]):
         return f"wss://api.deepgram.com/v1/listen?{urlencode(url_params)}"
 
     def is_speech_final(
-        self, current_buffer: str, deepgram_response: dict, time_silent: float
+        self,
+        current_buffer: List[str],
+        deepgram_response: DeepgramMsg,
+        top_choice: DeepgramAlternative,
+        time_silent: float,
     ):
-        transcript = deepgram_response["channel"]["alternatives"][0]["transcript"]
+        return self._is_speech_final(
+            current_buffer, deepgram_response, top_choice, time_silent
+        )
+
+    def _build_is_speech_final(
+        self,
+    ) -> Callable[[List[str], DeepgramMsg, DeepgramAlternative, float], bool]:
+        # the endpointing config is fixed per transcriber, so its type is
+        # resolved once here rather than on every Deepgram message
+        endpointing_config = self.transcriber_config.endpointing_config
 
         # if it is not time based, then return true if speech is final and there is a transcript
-        if not self.transcriber_config.endpointing_config:
-            return transcript and deepgram_response["speech_final"]
-        elif isinstance(
-            self.transcriber_config.endpointing_config, TimeEndpointingConfig
-        ):
+        if not endpointing_config:
+
+            def is_speech_final_default(
+                current_buffer, deepgram_response, top_choice, time_silent
+            ):
+                return top_choice.transcript and deepgram_response.speech_final
+
+            return is_speech_final_default
+        elif isinstance(endpointing_config, TimeEndpointingConfig):
+            time_cutoff_seconds = endpointing_config.time_cutoff_seconds
+
             # if it is time based, then return true if there is no transcript
             # and there is some speech to send
             # and the time_silent is greater than the cutoff
-            return (
-                not transcript
-                and current_buffer
-                and (time_silent + deepgram_response["duration"])
-                > self.transcriber_config.endpointing_config.time_cutoff_seconds
-            )
-        elif isinstance(
-            self.transcriber_config.endpointing_config, PunctuationEndpointingConfig
-        ):
-            return (
-                transcript
-                and deepgram_response["speech_final"]
-                and transcript.strip()[-1] in PUNCTUATION_TERMINATORS
-            ) or (
-                not transcript
-                and current_buffer
-                and (time_silent + deepgram_response["duration"])
-                > self.transcriber_config.endpointing_config.time_cutoff_seconds
-            )
+            def is_speech_final_time_based(
+                current_buffer, deepgram_response, top_choice, time_silent
+            ):
+                return (
+                    not top_choice.transcript
+                    and current_buffer
+                    and (time_silent + deepgram_response.duration) > time_cutoff_seconds
+                )
+
+            return is_speech_final_time_based
+        elif isinstance(endpointing_config, PunctuationEndpointingConfig):
+            time_cutoff_seconds = endpointing_config.time_cutoff_seconds
+
+            def is_speech_final_punctuation_based(
+                current_buffer, deepgram_response, top_choice, time_silent
+            ):
+                transcript = top_choice.transcript
+                return (
+                    transcript
+                    and deepgram_response.speech_final
+                    and ends_with_punctuation(transcript)
+                ) or (
+                    not transcript
+                    and current_buffer
+                    and (time_silent + deepgram_response.duration) > time_cutoff_seconds
+                )
+
+            return is_speech_final_punctuation_based
         raise Exception("Endpointing config not supported")
 
-    def calculate_time_silent(self, data: dict):
-        end = data["start"] + data["duration"]
-        words = data["channel"]["alternatives"][0]["words"]
+    def calculate_time_silent(self, data: DeepgramMsg, top_choice: DeepgramAlternative):
+        duration = data.duration
+        words = top_choice.words
         if words:
-            return end - words[-1]["end"]
-        return data["duration"]
+            return data.start + duration - words[-1].end
+        return duration
+
+    async def _next_redis_batch(self) -> List[bytes]:
+        batch = [await self._redis_queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + REDIS_PUBLISH_FLUSH_INTERVAL_SECONDS
+        while len(batch) < REDIS_PUBLISH_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._redis_queue.get(), timeout))
+            except asyncio.exceptions.TimeoutError:
+                break
+        return batch
+
+    async def redis_publisher(self):  # mirrors audio chunks to redis subscribers
+        while not self._ended:
+            batch = await self._next_redis_batch()
+            try:
+                async with self._redis.pipeline(transaction=False) as pipe:
+                    for chunk in batch:
+                        pipe.publish(REDIS_AUDIO_CHANNEL, chunk)
+                    await pipe.execute()
+            except RedisError as e:
+                self.logger.debug(f"Got error {e} publishing audio to redis")
 
     async def process(self):
-        self.audio_cursor = 0.0
+        self.audio_cursor_bytes = 0
         extra_headers = {"Authorization": f"Token {self.api_key}"}
 
-        async with websockets.connect(
-            self.get_deepgram_url(), extra_headers=extra_headers
+        async with connect(
+            self.get_deepgram_url(),
+            additional_headers=extra_headers,
+            # Deepgram frames are a few KB, so compressing them only costs CPU
+            compression=None,
         ) as ws:
+            self.last_connected_at = time.monotonic()
+            # audio goes up in small frames, so never hold them back for Nagle
+            sock = ws.transport.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 
-            async def sender(ws: WebSocketClientProtocol):  # sends audio to websocket
+            async def sender(ws: ClientConnection):  # sends audio to websocket
+                input_queue = self.input_queue
                 while not self._ended:
                     try:
-                        data = await asyncio.wait_for(self.input_queue.get(), 5)
+                        data = await asyncio.wait_for(input_queue.get(), 5)
                     except asyncio.exceptions.TimeoutError:
                         break
-                    num_channels = 1
-                    sample_width = 2
-                    self.audio_cursor += len(data) / (
-                        self.transcriber_config.sampling_rate
-                        * num_channels
-                        * sample_width
-                    )
+                    self.audio_cursor_bytes += len(data)
                     await ws.send(data)
                 self.logger.debug("Terminating Deepgram transcriber sender")
 
-            async def receiver(ws: WebSocketClientProtocol):
-                buffer = ""
-                buffer_avg_confidence = 0
+            async def receiver(ws: ClientConnection):
+                buffer_parts: List[str] = []
+                buffer_avg_confidence = 0.0
                 num_buffer_utterances = 1
-                time_silent = 0
+                time_silent = 0.0
                 transcript_cursor = 0.0
                 while not self._ended:
                     try:
-                        msg = await ws.recv()
+                        # the decoder reads the raw bytes, so skip decoding
+                        # text frames to str
+                        msg = await ws.recv(decode=False)
                     except Exception as e:
                         self.logger.debug(f"Got error {e} in Deepgram receiver")
                         break
-                    data = json.loads(msg)
+                    try:
+                        data = self._decoder.decode(msg)
+                    except msgspec.DecodeError as e:
+                        # e.g. event messages whose fields clash with the results
+                        # schema, these carry nothing the receiver needs
+                        self.logger.debug(f"Skipping Deepgram message: {e}")
+                        continue
                     if (
-                        not "is_final" in data
+                        data.is_final is None or data.channel is None
                     ):  # means we've finished receiving transcriptions
                         break
-                    cur_max_latency = self.audio_cursor - transcript_cursor
-                    transcript_cursor = data["start"] + data["duration"]
-                    cur_min_latency = self.audio_cursor - transcript_cursor
+                    duration = data.duration
+                    audio_cursor = self.audio_cursor
+                    cur_max_latency = audio_cursor - transcript_cursor
+                    transcript_cursor = data.start + duration
+                    cur_min_latency = audio_cursor - transcript_cursor
 
                     avg_latency_hist.record(
-                        (cur_min_latency + cur_max_latency) / 2 * data["duration"]
+                        (cur_min_latency + cur_max_latency) / 2 * duration
                     )
-                    duration_hist.record(data["duration"])
+                    duration_hist.record(duration)
 
                     # Log max and min latencies
                     max_latency_hist.record(cur_max_latency)
                     min_latency_hist.record(max(cur_min_latency, 0))
 
-                    is_final = data["is_final"]
-                    speech_final = self.is_speech_final(buffer, data, time_silent)
-                    top_choice = data["channel"]["alternatives"][0]
-                    confidence = top_choice["confidence"]
+                    self.received_transcription = True
+                    is_final = data.is_final
+                    top_choice = data.channel.alternatives[0]
+                    speech_final = self._is_speech_final(
+                        buffer_parts, data, top_choice, time_silent
+                    )
+                    transcript = top_choice.transcript
+                    confidence = top_choice.confidence
 
-                    if top_choice["transcript"] and confidence > 0.0 and is_final:
-                        buffer = f"{buffer} {top_choice['transcript']}"
+                    if transcript and confidence > 0.0 and is_final:
+                        buffer_parts.append(transcript)
                         if buffer_avg_confidence == 0:
                             buffer_avg_confidence = confidence
                         else:
@@ -260,28 +506,29 @@ class DeepgramTranscriber(BaseAsyncTranscriber[DeepgramTranscriberConfig]):
                         num_buffer_utterances += 1
 
                     if speech_final:
+                        self.cancel_interim()
                         self.output_queue.put_nowait(
                             Transcription(
-                                message=buffer,
+                                message=" ".join(buffer_parts),
                                 confidence=buffer_avg_confidence,
                                 is_final=True,
                             )
                         )
-                        buffer = ""
-                        buffer_avg_confidence = 0
+                        buffer_parts = []
+                        buffer_avg_confidence = 0.0
                         num_buffer_utterances = 1
-                        time_silent = 0
-                    elif top_choice["transcript"] and confidence > 0.0:
-                        self.output_queue.put_nowait(
+                        time_silent = 0.0
+                    elif transcript and confidence > 0.0:
+                        self.queue_interim(
                             Transcription(
-                                message=buffer,
+                                message=" ".join(buffer_parts),
                                 confidence=confidence,
                                 is_final=False,
                             )
                         )
-                        time_silent = self.calculate_time_silent(data)
+                        time_silent = self.calculate_time_silent(data, top_choice)
                     else:
-                        time_silent += data["duration"]
+                        time_silent += duration
                 self.logger.debug("Terminating Deepgram transcriber receiver")
 
             await asyncio.gather(sender(ws), receiver(ws))
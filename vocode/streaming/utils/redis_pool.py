@@ -0,0 +1,20 @@
+import os
+from redis.asyncio import ConnectionPool, Redis
+
+MAX_CONNECTIONS = 32
+
+# shared by every client in the process, so concurrent transcribers each get
+# their own in-flight connection instead of queueing behind a single socket
+pool = ConnectionPool(
+    host=os.environ.get("REDISHOST", "localhost"),
+    port=int(os.environ.get("REDISPORT", 6379)),
+    username=os.environ.get("REDISUSER", None),
+    password=os.environ.get("REDISPASSWORD", None),
+    db=0,
+    max_connections=MAX_CONNECTIONS,
+    socket_keepalive=True,
+)
+
+
+def get_redis_client() -> Redis:
+    return Redis(connection_pool=pool)